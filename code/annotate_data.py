@@ -1,10 +1,11 @@
 import datetime
-import json
 import csv
 import argparse
+import os
 from pathlib import Path
 import datetime
 import sys
+import helper_functions
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Provide cleaned data file and summary json for variant annotation.")
@@ -56,64 +57,83 @@ def parse_arguments():
     return parser
 
 
-def get_new_annotation(summary_report, annotation_dict, date_string):
+def load_summary_report(summary_report):
+    """Function to read a summary report json.
+
+    Parameters:
+        summary_report: path to the summary report json file.
+
+    Return:
+        Content of the summary report json.
+    """
+    with open(summary_report, "rb") as submission_response:  # json to be read
+        return helper_functions.load_json(submission_response.read())
+
+
+def get_new_annotation(summary_report, date_string):
     """Function to get the SCV accession number for all uploaded variants from the summary report json.
     If the variant was not uploaded but is already present and was not previously annotated, it will
     be this time round and will need to be updated.
+    Each summary report is parsed independently, so that several reports can be parsed in parallel.
 
     Parameters:
         summary_report: path to the summary report json file returned from "check_submission.py" script.
-        annotation_dict: initial dictionary containing annotation from reference file.
         date_string: date of upload, for further annotation.
     
     Return:
-        annotation_dict: updated dictionary containing for each submitted variant the corresponding SCV accession number from the current report summary json file parsed.
+        annotation_dict: dictionary containing for each submitted variant the corresponding SCV accession number from the current report summary json file parsed.
     """
-    with open(summary_report) as submission_response:  # json to be read
-        data = json.load(submission_response)
-        print(f'Annotating from date: {data["submissionDate"]}, submission: {summary_report}')
+    annotation_dict = {}
+    data = load_summary_report(summary_report)
+    print(f'Annotating from date: {data["submissionDate"]}, submission: {summary_report}')
     for submission in data["submissions"]:
-        try:
-            ID, SCV = (
-                submission["identifiers"]["clinvarLocalKey"].split("|")[0],
-                submission["identifiers"]["clinvarAccession"],
-            )  # successful uploads
-        except:
-            ID = submission["identifiers"]["clinvarLocalKey"].split("|")[0]
-            if submission["errors"][0]["output"]["errors"][0][
-                "userMessage"
-            ].startswith(
+        identifiers = submission["identifiers"]
+        ID = identifiers["clinvarLocalKey"].split("|", 1)[0]
+        SCV = identifiers.get("clinvarAccession")  # successful uploads
+        if SCV is None:
+            user_message = submission["errors"][0]["output"]["errors"][0]["userMessage"]
+            if user_message.startswith(
                 "This record is submitted as novel but"
             ):  # variants present, to be updated
-                message = submission["errors"][0]["output"]["errors"][0][
-                    "userMessage"
-                ].split()
-                SCV = message[23]
+                SCV = user_message.split()[23]
             else: #other reason for unseccesful upload; variant to be re-submitted
                 continue
         annotation_dict[ID] = {"SCV": SCV, "Last Edited": date_string}
     return annotation_dict
 
 
-def annotate_from_ref(reference_file):
-    """Function to extract the SCV accession numbers from the reference file.
+def read_reference(reference_file):
+    """Function to read the reference file, so that it is parsed only once for both annotation and copy of the previous haplotypes.
 
     Parameters:
         reference_file: reference file with previously uploaded variants, containing SCV field.
+
+    Return:
+        reference_rows: list of the variants in the reference file, empty if no reference file is given.
+    """
+    if not reference_file:
+        return []
+    with open(reference_file, "r", encoding="utf-8", buffering=helper_functions.BUFFER_SIZE, newline="") as ref:
+        return list(csv.DictReader(ref, delimiter="\t"))
+
+
+def annotate_from_ref(reference_rows):
+    """Function to extract the SCV accession numbers from the reference file.
+
+    Parameters:
+        reference_rows: variants of the reference file with previously uploaded variants, containing SCV field.
     
     Return:
         partial_annotation: dictionary where variant's ID contains its SCV accession number.
     """
     partial_annotation = {}
-    if reference_file:
-        with open(reference_file, "r", encoding="utf-8") as ref:
-            for line in csv.DictReader(ref, delimiter="\t"):
-                if len(line["hgvs c."]) > 0:
-                    ID = line["hgvs c."].split(",")[0] #if multiple hgvs c. are present, the first is considered the correct one by default and matching to the reference file
-                else:
-                    ID = get_id(line)
-                SCV = line["SCV"]
-                partial_annotation[ID] = {"SCV": SCV, "Last Edited": line["Last Edited"]}
+    for line in reference_rows:
+        if len(line["hgvs c."]) > 0:
+            ID = line["hgvs c."].split(",", 1)[0] #if multiple hgvs c. are present, the first is considered the correct one by default and matching to the reference file
+        else:
+            ID = get_id(line)
+        SCV = line["SCV"]
+        partial_annotation[ID] = {"SCV": SCV, "Last Edited": line["Last Edited"]}
     return partial_annotation
 
 
@@ -128,22 +148,13 @@ def get_id(variant):
     Return:
         variant_check: variant id in correct format.
         """
-    ref, alt = variant["Ref/Alt"].split("/")
-    variant_check = "_".join(
-        [
-            f'Chr.{variant["#Chromosome"]}',
-            str(
-                int(variant["Start"]) + 1
-            ),  # in summary report start position is increased by 1
-            variant["Stop"],
-            ref,
-            alt,
-        ]
-    ) #constructed ID to access dictionary with SCV numbers
-    if "-" in variant["Ref/Alt"].split("/")[0]:
-        variant_check = "_".join([variant_check, "Insertion"])
-    elif "-" in variant["Ref/Alt"].split("/")[1]:
-        variant_check = "_".join([variant_check, "Deletion"])
+    ref, alt = variant["Ref/Alt"].split("/", 1)
+    # in summary report start position is increased by 1
+    variant_check = f'Chr.{variant["#Chromosome"]}_{int(variant["Start"]) + 1}_{variant["Stop"]}_{ref}_{alt}' #constructed ID to access dictionary with SCV numbers
+    if ref == "-":
+        variant_check += "_Insertion"
+    elif alt == "-":
+        variant_check += "_Deletion"
     return variant_check
 
 
@@ -157,13 +168,12 @@ def get_summary_filepaths(summaries_list, variant_type = "variants"):
     Return:
         filenames: list of file paths to summary reports.
     """
-    with open(summaries_list) as f:
-        lines = f.readlines()
     filenames = []
-    for line in lines:
-        if variant_type in line:
-            summary_report = line.split("\n")[0].split(" ")[0]
-            filenames.append(summary_report)
+    with open(summaries_list) as f:
+        for line in f:
+            summary_report, _, report_type = line.strip().rpartition(" ") #each line is "<summary report path> <variants|haplotypes>"
+            if report_type == variant_type:
+                filenames.append(summary_report)
     return filenames
 
 
@@ -178,61 +188,60 @@ def annotate_file(summary_reports, input_file, reference_file, output_file, vari
         variant_type: whether to annotate 'variants' or 'haplotypes'.
         date_string: date of extraction of variants from VarSeq.
     """
-    annotation = annotate_from_ref(reference_file)
-    for f in get_summary_filepaths(summary_reports, variant_type):
-        annotation = get_new_annotation(f, annotation, date_string)
-    all_rows = []
-    if variant_type == "haplotypes": #read from the old annotated file the previous uploaded haplotypes to then be copied in the new file
-        if reference_file:
-            with open(reference_file, encoding="utf-8", mode="r+") as old_haplotypes:
-                csv_reader = csv.DictReader(old_haplotypes, delimiter="\t")
-                for row in csv_reader:
-                    all_rows.append(row)
-    with open(input_file, encoding="utf-8", mode="r+") as non_annotated:
-        csv_reader = csv.DictReader(non_annotated, delimiter="\t")
-        if "SCV" not in csv_reader.fieldnames:
-            csv_reader.fieldnames.append("SCV")
-            field_names = csv_reader.fieldnames
+    reference_rows = read_reference(reference_file)
+    annotation = annotate_from_ref(reference_rows)
+    summary_paths = get_summary_filepaths(summary_reports, variant_type)
+    for summary_path in summary_paths: #merged in order, so the latest report takes precedence
+        annotation.update(get_new_annotation(summary_path, date_string))
+    annotation_get = annotation.get
+    temp_output_file = f"{output_file}.tmp" #written aside and moved at the end, so that the input is not truncated if it is also the output
+    with open(input_file, encoding="utf-8", mode="r", buffering=helper_functions.BUFFER_SIZE, newline="") as non_annotated, open(
+        temp_output_file, encoding="utf-8", mode="w", newline=""
+    ) as outfile:
+        csv_reader = csv.reader(non_annotated, delimiter="\t")
+        field_names = next(csv_reader)
+        if "SCV" not in field_names:
+            field_names.append("SCV")
+        columns = {name: i for i, name in enumerate(field_names)}
+        hgvs, last_edited, scv = columns["hgvs c."], columns["Last Edited"], columns["SCV"]
+        csv_writer = csv.writer(outfile, delimiter="\t")
+        csv_writer.writerow(field_names)
+        if variant_type == "haplotypes": #previous uploaded haplotypes are copied from the old annotated file to the new one
+            csv.DictWriter(outfile, fieldnames=field_names, delimiter="\t").writerows(reference_rows)
         for row in csv_reader:
-            if row["hgvs c."]: #if hgvs c. field present for the variant this is used to find corresponding SCV number
-                hgvs_field = row["hgvs c."].split(",")[0]
-                if hgvs_field in annotation.keys():
-                    row["SCV"] = annotation[hgvs_field]["SCV"]
-                    row["Last Edited"] = annotation[hgvs_field]["Last Edited"]
-                    row["hgvs c."] = hgvs_field
+            if not row:
+                continue
+            row.extend([""] * (len(field_names) - len(row))) #empty SCV field for variants not annotated
+            if row[hgvs]: #if hgvs c. field present for the variant this is used to find corresponding SCV number
+                hgvs_field = row[hgvs].split(",", 1)[0]
+                variant_annotation = annotation_get(hgvs_field)
+                if variant_annotation:
+                    row[scv] = variant_annotation["SCV"]
+                    row[last_edited] = variant_annotation["Last Edited"]
+                    row[hgvs] = hgvs_field
             else: #otherwise the ID has to be constructed with the variant's information
-                variant_check = get_id(row)
-                if variant_check in annotation.keys(): #check whether variant was uploaded/updated
-                    row["SCV"] = annotation[variant_check]["SCV"]
-                    row["Last Edited"] = annotation[variant_check]["Last Edited"]
-            all_rows.append(row)
-            
-    with open(output_file, encoding="utf-8", mode="w", newline="") as outfile:
-        csv_writer = csv.DictWriter(
-            outfile, fieldnames=field_names, delimiter="\t"
-        )
-        csv_writer.writeheader()
-        csv_writer.writerows(all_rows)
+                variant_annotation = annotation_get(get_id(dict(zip(field_names, row))))
+                if variant_annotation: #check whether variant was uploaded/updated
+                    row[scv] = variant_annotation["SCV"]
+                    row[last_edited] = variant_annotation["Last Edited"]
+            csv_writer.writerow(row)
+    os.replace(temp_output_file, output_file)
 
 
 if __name__ == "__main__":
     parser = parse_arguments()
     args = parser.parse_args()
-    if len(args.date_of_extraction) == 10:
-        try:
-            datetime.datetime.strptime(args.date_of_extraction, '%Y-%m-%d')
-            # date_check = bool(date_parser.parse(args.date_of_extraction))
-            date_of_interest = args.date_of_extraction
-        except ValueError:
-            print("Error: Date of extraction must be in format %YYYY-%mm-%dd")
-            sys.exit(1)
-    else:
+    try: #round trip so that only zero-padded dates are accepted, as they are compared as strings
+        date_of_interest = datetime.datetime.strptime(args.date_of_extraction, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        date_of_interest = None
+    if date_of_interest != args.date_of_extraction:
         print("Error: Date of extraction must be in format %YYYY-%mm-%dd")
         sys.exit(1)
     
     if args.output_file is None:
-        args.output_file = Path(f'data\{"somatic" if args.somatic else "germline"}_{args.variant_type}_uploaded_annotated_{date_of_interest}.tsv')
+        args.output_file = Path("data") / f'{"somatic" if args.somatic else "germline"}_{args.variant_type}_uploaded_annotated_{date_of_interest}.tsv'
     else: #check it is saved in 'data' folder
-        if args.output_file.split("\\")[0] != "data":
-            args.output_file = f'data\\{args.output_file}'
+        if args.output_file.parts[0] != "data":
+            args.output_file = Path("data") / args.output_file
     annotate_file(args.summary_files, args.input_file, args.reference_file, args.output_file, args.variant_type, date_of_interest)
@@ -1,4 +1,5 @@
 import csv
+import helper_functions
 
 def read_file(file_variants):
     """Function to read the variants into a dictionary.
@@ -9,13 +10,29 @@ def read_file(file_variants):
     Returns:
         file_entries: dictionary containing all variants from the corresponding file."""
 
-    with open(file_variants, encoding="utf-8", mode="r") as f:
+    with open(file_variants, encoding="utf-8", mode="r", buffering=helper_functions.BUFFER_SIZE, newline="") as f:
         file_reader = csv.DictReader(f, delimiter="\t")
         file_entries = []
         for new_variant in file_reader:
             file_entries.append(new_variant)
     return file_entries
 
+def read_rows(file_variants):
+    """Function to read the variants as lists of fields, without building a dictionary for each of them.
+
+    Parameteres:
+        file_variants: filepath to latest tsv file containing the variants.
+
+    Returns:
+        field_names: list of the column names of the file.
+        file_rows: list containing all variants from the corresponding file, each as a list of fields ordered as field_names."""
+
+    with open(file_variants, encoding="utf-8", mode="r", buffering=helper_functions.BUFFER_SIZE, newline="") as f:
+        file_reader = csv.reader(f, delimiter="\t")
+        field_names = next(file_reader)
+        file_rows = [row for row in file_reader if row]
+    return field_names, file_rows
+
 def compare_variants(new_variants, old_variants, date_of_upload):
     """Function to compare the new variants from the input file to the reference file.
 
@@ -32,45 +49,42 @@ def compare_variants(new_variants, old_variants, date_of_upload):
         variants_upload: list containing variants to be uploaded as novel.
         variants_update: list containing variants to be updated."""
 
-    new_entries = read_file(new_variants)
-    old_entries = read_file(old_variants)
+    new_fields, new_entries = read_rows(new_variants)
+    old_fields, old_entries = read_rows(old_variants)
+    new_columns = {name: i for i, name in enumerate(new_fields)}
+    old_columns = {name: i for i, name in enumerate(old_fields)}
+    # index the reference variants once, the first occurrence in the file is the one matched
+    old_by_hgvs = {}
+    old_by_coords = {}
+    for old_variant in old_entries:
+        if old_variant[old_columns["hgvs c."]]:
+            old_by_hgvs.setdefault(old_variant[old_columns["hgvs c."]], old_variant)
+        old_variant_coords = (
+            old_variant[old_columns["#Chromosome"]],
+            old_variant[old_columns["Start"]],
+            old_variant[old_columns["Stop"]],
+            old_variant[old_columns["Ref/Alt"]],
+        )
+        old_by_coords.setdefault(old_variant_coords, old_variant)
+    old_last_edited, old_scv = old_columns["Last Edited"], old_columns["SCV"]
+    hgvs, chrom, start, stop, ref_alt, last_edited = (
+        new_columns[name] for name in ("hgvs c.", "#Chromosome", "Start", "Stop", "Ref/Alt", "Last Edited")
+    )
     variants_update = []
     variants_upload = []
     for new_variant in new_entries:
-        new_variant_coords = "\t".join(
-            [
-                new_variant["#Chromosome"],
-                new_variant["Start"],
-                new_variant["Stop"],
-                new_variant["Ref/Alt"],
-            ]
-        )
-        to_update = False
-        up_to_date = False
-        for old_variant in old_entries:
-            old_variant_coords = "\t".join(
-                [
-                    old_variant["#Chromosome"],
-                    old_variant["Start"],
-                    old_variant["Stop"],
-                    old_variant["Ref/Alt"],
-                ]
-            )
-            if (new_variant["hgvs c."] == old_variant["hgvs c."] != "") or (
-                new_variant_coords == old_variant_coords
-            ):
-                if new_variant["Last Edited"] <= old_variant["Last Edited"]:
-                    up_to_date = True
-                    break
-                else:
-                    if old_variant["SCV"] == "": break #missing SCV for them, will likely result in error when uploaded
-                    new_variant["SCV"] = old_variant["SCV"]
-                    new_variant["Last Edited"] = date_of_upload
-                    variants_update.append(new_variant)
-                    to_update = True
-                    break
-        if not to_update and not up_to_date:  # it's a new variant (no SCV)
-            variants_upload.append(new_variant)
+        new_variant_coords = (new_variant[chrom], new_variant[start], new_variant[stop], new_variant[ref_alt])
+        old_variant = old_by_hgvs.get(new_variant[hgvs]) or old_by_coords.get(new_variant_coords)
+        if old_variant is None:  # it's a new variant (no SCV)
+            variants_upload.append(dict(zip(new_fields, new_variant)))
+        elif new_variant[last_edited] > old_variant[old_last_edited]:
+            if old_variant[old_scv] == "": #missing SCV for them, will likely result in error when uploaded
+                variants_upload.append(dict(zip(new_fields, new_variant)))
+                continue
+            new_variant = dict(zip(new_fields, new_variant))
+            new_variant["SCV"] = old_variant[old_scv]
+            new_variant["Last Edited"] = date_of_upload
+            variants_update.append(new_variant)
     return variants_upload, variants_update
 
 def compare_haplotypes(new_haplos, old_haplos):
@@ -83,26 +97,19 @@ def compare_haplotypes(new_haplos, old_haplos):
     
     Output:
         haplos_novel: list containing haplotypes to be uploaded as novel.
-        haplos_update: list containing haplotypes to be updated."""
+        haplos_update: list containing haplotypes to be updated, with the SCV accession number of the previous upload appended to their data."""
     
     old_haplos = read_file(old_haplos)
+    old_by_hgvs = {}
+    for old_haplo in old_haplos:
+        old_by_hgvs.setdefault(old_haplo["hgvs c."], old_haplo)
     haplos_novel = {}
     haplos_update = {}
-    for new_haplo in new_haplos:
-        to_update = False
-        up_to_date = False
-        new_associated_variants, new_haplo_hgvsc, new_haplo_hgvsp, new_haplo_classification, new_upload_type, new_last_edited = new_haplos[new_haplo].strip(" ").split("; ")
-        for old_haplo in old_haplos:
-            if new_haplo == old_haplo["hgvs c."]: #new_haplo is hgvs c., key of the haplotype dictionary
-                old_haplo_hgvsc, old_haplo_classification, old_associated_variants, old_haplo_hgvsp, old_last_edited, old_haplo_SCV = old_haplo.values()
-                if new_last_edited <= old_last_edited: #up to date
-                    up_to_date = True
-                    break
-                else: 
-                    new_haplo_info = "; ".join([new_haplos[new_haplo], old_haplo_SCV])
-                    to_update = True
-                    haplos_update[new_haplo] = new_haplo_info
-                    break
-        if not to_update and not up_to_date: # new haplotype
+    for new_haplo in new_haplos: #new_haplo is hgvs c., key of the haplotype dictionary
+        new_associated_variants, new_haplo_hgvsc, new_haplo_hgvsp, new_haplo_classification, new_upload_type, new_last_edited = new_haplos[new_haplo]
+        old_haplo = old_by_hgvs.get(new_haplo)
+        if old_haplo is None: # new haplotype
             haplos_novel[new_haplo] = new_haplos[new_haplo]
+        elif new_last_edited > old_haplo["Last Edited"]: #to be updated, otherwise up to date
+            haplos_update[new_haplo] = new_haplos[new_haplo] + (old_haplo["SCV"],)
     return haplos_novel, haplos_update
@@ -1,5 +1,11 @@
-import csv, copy
+import csv
+import hashlib
+import json
+import os
 import re
+import helper_functions
+
+MERGE_PATTERN = re.compile(r"\[MERGE:(.+)\]")  # haplotype syntax in the catalogue's "Notes" field
 
 
 def separate_variants(two_variants):
@@ -14,12 +20,13 @@ def separate_variants(two_variants):
     Return:
         the two single variants."""
 
-    v1 = copy.deepcopy(two_variants)
-    v1["Ref/Alt"] = "/".join(two_variants["Ref/Alt"].split("/")[:2])
-    v2 = copy.deepcopy(two_variants)
-    v2["Ref/Alt"] = "/".join(two_variants["Ref/Alt"].split("/")[::2])
+    ref, alt1, alt2 = two_variants["Ref/Alt"].split("/", 2)
+    v1 = two_variants.copy()
+    v1["Ref/Alt"] = f"{ref}/{alt1}"
+    v2 = two_variants.copy()
+    v2["Ref/Alt"] = f"{ref}/{alt2}"
     if "," in two_variants["hgvs c."]:
-        v1["hgvs c."], v2["hgvs c."] = two_variants["hgvs c."].split(",")
+        v1["hgvs c."], v2["hgvs c."] = two_variants["hgvs c."].split(",", 1)
     else:
         v2[
             "hgvs c."
@@ -27,123 +34,59 @@ def separate_variants(two_variants):
     return v1, v2
 
 
-def correct_format(ref, alt, start, stop, cursor, step):
+def correct_format(ref, alt, start, stop):
     """Function to reduce the variants to the minimal writing of alleles and consequently modifying the genomic position.
 
-    It compares the strings of reference and alternate alleles until one of them ends or there is a difference.
-    The direction of comparison is determmined by the cursor and step values.
+    The suffix in common to reference and alternate alleles is removed first, then the prefix in common to what is left of them.
+    Start and stop positions are moved by the number of nucleotides removed from each end, and an allele left empty is replaced by "-".
 
     Parameters:
         ref: reference allele.
         alt: alternate allele.
         start: start position of variant.
         stop: stop position of variant.
-        cursor: for indexing of the alleles (strings), either 0 or -1.
-        step: indicating which direction the comparison of the strings will happen.
 
     Return:
         New parameters for reference, alternate alleles, start and stop positions."""
 
-    subset = False
-    while abs(cursor) < len(ref) and abs(cursor) < len(alt):
-        if ref[cursor] != alt[cursor]:
-            subset = (
-                True  # if only a subset of both alleles is in common, iteration stopped
-            )
-            break
-        cursor += step
-    if subset and cursor < -1:  # suffix in common
-        # cursor has to be increased by one for proper indexing and location
-        ref = ref[: cursor + 1]  # extract new reference allele
-        alt = alt[: cursor + 1]  # extract new alternate allele
-        stop = str(
-            int(stop) + cursor + 1
-        )  # stop position is updated base on length of suffix
-        if ref[0] == alt[0]:  # if also prefix in common the function is recalled
-            return correct_format(ref, alt, start, stop, cursor=0, step=1)
-    elif subset and cursor > 0:  # prefix in common
-        ref = ref[cursor:]  # update alleles
-        alt = alt[cursor:]
-        start = str(
-            int(start) + cursor
-        )  # start position updated based on length of prefix
-    # if whole reference is subset of alternate allele
-    elif abs(cursor) > len(ref):  # insertion
-        if cursor > 0:
-            alt = alt[cursor:]
-            start = str(int(start) + cursor)
-        else:
-            # N.B. again cursor to be increased by 1 when negative
-            alt = alt[: cursor + 1]
-            stop = str(int(stop) + cursor + 1)
-        ref = ["-"]  # reference allele becomes empty as is insertion
-    # if whole alternate is subset of reference allele
-    # same reasoning as for the insertion case above
-    elif abs(cursor) > len(alt):  # deletion
-        if cursor > 0:
-            ref = ref[cursor:]
-            start = str(int(start) + cursor)
-        else:
-            ref = ref[: cursor + 1]
-            stop = str(int(stop) + cursor + 1)
-        alt = ["-"]
-    # when cursor is same as allele length
-    # extra cases where while loop ended without finding subset
-    elif abs(cursor) == len(ref):
-        if not ref[cursor] == alt[cursor] and cursor < 0:
-            # if first nt of alleles are different
-            ref = ref[0]
-            if (
-                cursor == -1
-            ):  # if while loop is not even executed (ref allele has length 1)
-                alt = alt  # no change to the reference allele
-            else:
-                alt = alt[: cursor + 1]
-            stop = str(int(stop) + cursor + 1)
-        elif cursor < 0:  # if they are the same, i.e. insertion
-            if (
-                cursor == -1
-            ):  # if while loop is not even executed (ref allele has length 1)
-                alt = alt[:cursor]  # no need to increase cursor in this case
-            else:
-                alt = alt[:cursor]
-                stop = str(int(stop) + cursor)  # no need to increase cursor
-            ref = ["-"]
-        else:  # if cursor >0 then it is an insertion
-            # comparison of alleles has already been done because indexing starts at 0, not 1
-            alt = alt[cursor:]
-            ref = ["-"]
-            start = str(int(start) + cursor)
-    # same reasoning as above
-    elif abs(cursor) == len(alt):
-        if not ref[cursor] == alt[cursor]:
-            if cursor > 0:
-                ref = ref[cursor:]
-                alt = alt[-1]
-                start = str(int(start) + cursor)
-            else:
-                ref = ref[: cursor + 1]
-                alt = alt[0]
-                stop = str(int(stop) + cursor)
-        else:
-            if cursor > 0:
-                ref = ref[cursor:]
-                start = str(int(start) + cursor)
-            else:
-                ref = ref[:cursor]
-                stop = str(int(stop) + cursor)
-            alt = ["-"]
-    return "/".join(["".join(ref), "".join(alt)]), start, stop
-
-
-def check_variant(variant, reference_file):
+    shortest = min(len(ref), len(alt))
+    suffix = 0
+    while suffix < shortest and ref[-1 - suffix] == alt[-1 - suffix]:
+        suffix += 1
+    ref = ref[: len(ref) - suffix]
+    alt = alt[: len(alt) - suffix]
+    prefix = 0
+    while prefix < shortest - suffix and ref[prefix] == alt[prefix]:
+        prefix += 1
+    ref = ref[prefix:] or "-"  # reference allele becomes empty if insertion
+    alt = alt[prefix:] or "-"  # alternate allele becomes empty if deletion
+    return "/".join([ref, alt]), str(int(start) + prefix), str(int(stop) - suffix)
+
+
+def index_variant(chromosome, start, stop, ref_alt, hgvs, seen_coords, seen_hgvs):
+    """Function to record a variant written to the output file, so that check_variant does not need to read the file again.
+
+    Parameters:
+        chromosome, start, stop, ref_alt: coordinates and alleles of the variant written to the output file.
+        hgvs: hgvs c. of the variant, recorded only if present.
+        seen_coords: set of (chromosome, start, stop, ref/alt) of the variants already written.
+        seen_hgvs: set of hgvs c. of the variants already written."""
+
+    seen_coords.add((chromosome, start, stop, ref_alt))
+    if hgvs:
+        seen_hgvs.add(hgvs)
+
+
+def check_variant(variant, seen_coords, seen_hgvs):
     """Function to check whether the variant is already present in the file after having obtained the alleles in the correct format.
 
     Parameters:
         variant: variant to be checked.
+        seen_coords: set of (chromosome, start, stop, ref/alt) of the variants already written to the file.
+        seen_hgvs: set of hgvs c. of the variants already written to the file.
 
     Return:
-        Boolean value: "True" if the variant is not present in the file and to be added to it, "False" oterwise."""
+        Boolean value: "True" if the variant is not present in the file and to be added to it (it is then recorded in the sets), "False" oterwise."""
 
     # modify alleles if there is overlap
     ref, alt = variant["Ref/Alt"].split("/")
@@ -151,44 +94,23 @@ def check_variant(variant, reference_file):
         not (alt != "-" and ref == "-")
         and not (ref != "-" and alt == "-")
         and not (len(ref) == len(alt) == 1)
+        and (ref[-1] == alt[-1] or ref[0] == alt[0])  # common suffix or prefix
     ):
-        if (
-            ref[-1] == alt[-1]
-        ):  # check for common suffix, and also for possible prefix afterwards
-            variant["Ref/Alt"], variant["Start"], variant["Stop"] = correct_format(
-                ref, alt, variant["Start"], variant["Stop"], cursor=-1, step=-1
-            )
-            variant[
-                "hgvs c."
-            ] = ""  # delete hgvs c. as will be wrong, possibly to be generated manually
-        elif ref[0] == alt[0]:  # check for common prefix
-            variant["Ref/Alt"], variant["Start"], variant["Stop"] = correct_format(
-                ref, alt, variant["Start"], variant["Stop"], cursor=0, step=1
-            )
-            variant[
-                "hgvs c."
-            ] = ""  # delete hgvs c. as will be wrong, possibly to be generated manually
-    variant_check = "\t".join(
-        [variant["#Chromosome"], variant["Start"], variant["Stop"], variant["Ref/Alt"]]
-    )
-
-    # check if variant already present in file being written
-    with open(reference_file, encoding="utf-8", mode="r+") as check_outfile:
-        outfile_reader = csv.DictReader(check_outfile, delimiter="\t")
-        for element in outfile_reader:
-            if variant["hgvs c."]:
-                if variant["hgvs c."] == element["hgvs c."]:
-                    return False
-            check_line = "\t".join(
-                [
-                    element["#Chromosome"],
-                    element["Start"],
-                    element["Stop"],
-                    element["Ref/Alt"],
-                ]
-            )
-            if variant_check == check_line:
-                return False
+        variant["Ref/Alt"], variant["Start"], variant["Stop"] = correct_format(
+            ref, alt, variant["Start"], variant["Stop"]
+        )
+        variant[
+            "hgvs c."
+        ] = ""  # delete hgvs c. as will be wrong, possibly to be generated manually
+
+    # check if variant already present in file being written, and record it otherwise
+    hgvs = variant["hgvs c."]
+    if hgvs and hgvs in seen_hgvs:
+        return False
+    chromosome, start, stop, ref_alt = variant["#Chromosome"], variant["Start"], variant["Stop"], variant["Ref/Alt"]
+    if (chromosome, start, stop, ref_alt) in seen_coords:
+        return False
+    index_variant(chromosome, start, stop, ref_alt, hgvs, seen_coords, seen_hgvs)
     return True
 
 
@@ -207,15 +129,59 @@ def extract_variants(variant):
         First variant from inputted list that contains both correct hgvs c. syntax and gene name."""
 
     hgvs_list = variant["hgvs c."].split(",")
-    genes_list = variant["Gene Names"].split(",")
-    for i in range(len(hgvs_list)):
-        if not hgvs_list[i].startswith("NM"):
-            continue
-        else:
-            single_variant = copy.deepcopy(variant)
-            single_variant["hgvs c."] = hgvs_list[i]
-            single_variant["Gene Names"] = genes_list[i]
-            return single_variant
+    i = next((j for j, hgvs in enumerate(hgvs_list) if hgvs.startswith("NM")), None)
+    if i is None:
+        return None
+    single_variant = variant.copy()
+    single_variant["hgvs c."] = hgvs_list[i]
+    single_variant["Gene Names"] = variant["Gene Names"].split(",")[i]
+    return single_variant
+
+
+def get_cache_key(input_file):
+    """Function to compute the key identifying the version of the input file a cleaned file was produced from.
+    The key also changes if this module is modified, so that a cleaned file is not reused after a change of the cleaning steps.
+
+    Parameters:
+        input_file: initial tsv file containing the variants.
+
+    Return:
+        Key as a short hexadecimal string."""
+
+    stats = f"{os.path.getmtime(input_file)}:{os.path.getsize(input_file)}:{os.path.getmtime(__file__)}"
+    return hashlib.sha256(stats.encode()).hexdigest()[:16]
+
+
+def read_cache(output_file, cache_key):
+    """Function to retrieve the haplotypes of a previous cleaning of the same input file.
+
+    Parameters:
+        output_file: cleaned tsv file with the variants.
+        cache_key: key of the current input file, from get_cache_key.
+
+    Return:
+        haplotypes_dict: dictionary of the haplotypes' data if the cleaned file is up to date, "None" otherwise."""
+
+    try:
+        with open(f"{output_file}.key", encoding="utf-8") as key_file:
+            cache = json.load(key_file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("key") != cache_key or not os.path.exists(output_file):
+        return None
+    return {hgvsc: tuple(haplotype) for hgvsc, haplotype in cache["haplotypes"].items()}
+
+
+def write_cache(output_file, cache_key, haplotypes_dict):
+    """Function to store the key of the input file and the haplotypes next to the cleaned file, for read_cache.
+
+    Parameters:
+        output_file: cleaned tsv file with the variants.
+        cache_key: key of the current input file, from get_cache_key.
+        haplotypes_dict: dictionary of the haplotypes' data extracted during cleaning."""
+
+    with open(f"{output_file}.key", encoding="utf-8", mode="w") as key_file:
+        json.dump({"key": cache_key, "haplotypes": haplotypes_dict}, key_file)
 
 
 def clean_data(input_file):
@@ -231,69 +197,72 @@ def clean_data(input_file):
 
     Return:
         output_file: modified/cleaned tsv file with the variants.
-        haplotypes_dict: dictionary of the haplotypes' data extracted from the syntax in the catalogue's "INFO" field."""
+        haplotypes_dict: dictionary of the haplotypes' data extracted from the syntax in the catalogue's "INFO" field,
+            as tuples of (associated variants, hgvs c., hgvs p., classification, upload type, last edited date)."""
 
-    file_basename = input_file.split("\\")[-1].split(".")[0]
-    output_file = f'temp\{file_basename}_cleaned.txt'
+    file_basename = os.path.splitext(os.path.basename(input_file))[0]
+    output_file = os.path.join("temp", f"{file_basename}_cleaned.txt")
+    cache_key = get_cache_key(input_file)
+    haplotypes_dict = read_cache(output_file, cache_key)
+    if haplotypes_dict is not None: #input file unchanged since last cleaning
+        return output_file, haplotypes_dict
 
-    with open(input_file, encoding="utf-8", mode="r") as original_tsv, open(
-        output_file, encoding="utf-8", mode="w", newline=""
+    with open(
+        input_file, encoding="utf-8", mode="r", buffering=helper_functions.BUFFER_SIZE, newline=""
+    ) as original_tsv, open(
+        output_file, encoding="utf-8", mode="w", buffering=helper_functions.BUFFER_SIZE, newline=""
     ) as outfile:
-        csv_reader = csv.DictReader(original_tsv, delimiter="\t")
-        csv_writer = csv.DictWriter(
-            outfile, fieldnames=csv_reader.fieldnames, delimiter="\t"
+        csv_reader = csv.reader(original_tsv, delimiter="\t")
+        field_names = next(csv_reader)
+        columns = {name: i for i, name in enumerate(field_names)}
+        chrom, start, stop, ref_alt, hgvs, notes, last_edited = (
+            columns[name] for name in ("#Chromosome", "Start", "Stop", "Ref/Alt", "hgvs c.", "Notes", "Last Edited")
         )
-        csv_writer.writeheader()
+        csv_writer = csv.writer(outfile, delimiter="\t")
+        csv_writer.writerow(field_names)
 
         triple_variants = []
         multiple_hgvs = []
         haplotypes_dict = {}
+        # variants written to the output file, used to check for duplicates
+        seen_coords = set()
+        seen_hgvs = set()
         for variant in csv_reader:
-            if len(variant["Ref/Alt"].split("/")) == 3:
-                triple_variants.append(variant)
-            elif "," in variant["hgvs c."]:
-                if not "[MERGE:" in variant["Notes"]:
-                    multiple_hgvs.append(variant)
-            elif "[MERGE:" in variant["Notes"]:
-                merge_info = re.search(r'\[MERGE:(.+)\]', variant["Notes"]).group(1)
+            if not variant:
+                continue
+            if variant[ref_alt].count("/") == 2:
+                triple_variants.append(dict(zip(field_names, variant)))
+                continue
+            if "," in variant[hgvs]:
+                if not "[MERGE:" in variant[notes]:
+                    multiple_hgvs.append(dict(zip(field_names, variant)))
+                continue
+            if "[MERGE:" in variant[notes]:
+                merge_info = MERGE_PATTERN.search(variant[notes]).group(1)
                 merge_info_mod = merge_info.replace("&gt;", ">")
                 associated_variants, haplo_hgvsc, haplo_hgvsp, haplo_classification, upload_type = merge_info_mod.strip(" ").split("; ")
-                last_edited_date = variant["Last Edited"]
+                last_edited_date = variant[last_edited]
                 if haplo_hgvsc not in haplotypes_dict:
-                    haplotypes_dict[haplo_hgvsc] = "; ".join([merge_info_mod, last_edited_date])
-                if upload_type == "individual-merged":
-                    # variant to be uploaded individually AND as part of haplotype
-                    csv_writer.writerow(variant)
-            else:
-                csv_writer.writerow(variant)
-        new_variants = []
-    for variant in multiple_hgvs:
-        new_variant = extract_variants(variant)
-        new_variants.append(new_variant)
-
-    with open(
-        output_file, encoding="utf-8", mode="a", newline=""
-    ) as check_outfile:
-        csv_writer = csv.DictWriter(
-            check_outfile, fieldnames=csv_reader.fieldnames, delimiter="\t"
-        )
-        csv_writer.writerows(new_variants)
-    for variant in triple_variants:
-        v1, v2 = separate_variants(variant)
-        if check_variant(v1, output_file):
-            with open(
-                output_file, encoding="utf-8", mode="a", newline=""
-            ) as check_outfile:
-                csv_writer = csv.DictWriter(
-                    check_outfile, fieldnames=csv_reader.fieldnames, delimiter="\t"
-                )
-                csv_writer.writerow(v1)
-        if check_variant(v2, output_file):
-            with open(
-                output_file, encoding="utf-8", mode="a", newline=""
-            ) as check_outfile:
-                csv_writer = csv.DictWriter(
-                    check_outfile, fieldnames=csv_reader.fieldnames, delimiter="\t"
-                )
-                csv_writer.writerow(v2)
+                    haplotypes_dict[haplo_hgvsc] = (associated_variants, haplo_hgvsc, haplo_hgvsp, haplo_classification, upload_type, last_edited_date)
+                if upload_type != "individual-merged":
+                    continue
+                # variant to be uploaded individually AND as part of haplotype
+            csv_writer.writerow(variant)
+            index_variant(variant[chrom], variant[start], variant[stop], variant[ref_alt], variant[hgvs], seen_coords, seen_hgvs)
+
+        # variants extracted from multiple hgvs c. and split from triple alleles, appended at the end of the file
+        extra_rows = []
+        for variant in multiple_hgvs:
+            new_variant = extract_variants(variant)
+            extra_rows.append(new_variant)
+            index_variant(
+                new_variant["#Chromosome"], new_variant["Start"], new_variant["Stop"], new_variant["Ref/Alt"],
+                new_variant["hgvs c."], seen_coords, seen_hgvs
+            )
+        for variant in triple_variants:
+            for single_variant in separate_variants(variant):
+                if check_variant(single_variant, seen_coords, seen_hgvs):
+                    extra_rows.append(single_variant)
+        csv.DictWriter(outfile, fieldnames=field_names, delimiter="\t").writerows(extra_rows)
+    write_cache(output_file, cache_key, haplotypes_dict)
     return output_file, haplotypes_dict
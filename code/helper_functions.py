@@ -1,14 +1,73 @@
-import copy
 import csv
 from datetime import date
-import os
-from re import sub
+from functools import lru_cache
+import json
+from operator import itemgetter
+import re
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library json module is used otherwise
+    orjson = None
 
 BASE_PAIRS = {"A": "T", "C": "G", "G": "C", "T": "A"}
+BASE_PAIRS_TABLE = str.maketrans("ACGTNacgtn", "TGCANtgcan")  # translation table for get_reverse_strand, case kept and N unchanged
 SUB_URL = "https://submit.ncbi.nlm.nih.gov/api/v1/submissions"
 TEST_URL = "https://submit.ncbi.nlm.nih.gov/apitest/v1/submissions"
+PARENTHESIS_PATTERN = re.compile(r"\([^)]*\)")  # uncertain length in the hgvs c., e.g. "(3)"
+BUFFER_SIZE = 1 << 20  # 1 MiB buffer for reading and writing tsv files
 
 SOMATIC_CLASSIFICATION_MAPPING = {"Pathogenic": "Oncogenic", "Likely pathogenic": "Likely oncogenic", "Uncertain significance": "Uncertain significance", "Likely benign":"Likely benign", "Benign": "Benign"}
+NOT_SPECIFIED_CLASSIFICATIONS = frozenset(("Benign", "Likely benign", "Uncertain significance"))  # condition "not specified" for germline
+
+def load_json(content):
+    """Function to parse json content, using orjson if installed as it is considerably faster than the standard library.
+
+    Parameters:
+        content: json document, as bytes or string.
+
+    Return:
+        Parsed json object."""
+
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+@lru_cache(maxsize=None)
+def normalize_classification(classification, somatic_flag):
+    """Function to convert the classification from the input file into the description accepted by ClinVar.
+    Only a handful of different classifications are found in a file, hence the results are cached.
+
+    Parameters:
+        classification: classification of the variant or haplotype as found in the input file.
+        somatic_flag: boolean value to determine whether the classification is to be mapped to the oncogenicity one.
+
+    Return:
+        Classification description for the submission."""
+
+    classification = classification.capitalize()
+    if classification == "Unknown significance":
+        classification = "Uncertain significance"  # ClinVar requirement
+    if somatic_flag:
+        classification = SOMATIC_CLASSIFICATION_MAPPING[classification]
+    return classification
+
+
+def dump_json(content, indent=True):
+    """Function to serialise an object to json, using orjson if installed as it is considerably faster than the standard library.
+
+    Parameters:
+        content: object to be serialised.
+        indent: boolean value to determine whether the json is indented (for files) or compact (for requests).
+
+    Return:
+        Json document as utf-8 encoded bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(content, indent=2 if indent else None).encode("utf-8")
+
 
 def get_reverse_strand(sequence):
     """Function to obtain the reverse-complement of a genomic sequence.
@@ -19,8 +78,7 @@ def get_reverse_strand(sequence):
     Return:
         Reverse-complement of the sequence"""
 
-    comp = [BASE_PAIRS[nt] for nt in list(sequence)]
-    return "".join(comp[::-1])
+    return sequence.translate(BASE_PAIRS_TABLE)[::-1]
 
 
 def fix_coordinates(sample):
@@ -38,28 +96,21 @@ def fix_coordinates(sample):
     Return:
         Modified sample"""
 
-    ref_allele = sample["variantSet"]["variant"][0]["chromosomeCoordinates"][
-        "referenceAllele"
-    ]
-    alt_allele = sample["variantSet"]["variant"][0]["chromosomeCoordinates"][
-        "alternateAllele"
-    ]
-    if (
-        sample["variantSet"]["variant"][0]["chromosomeCoordinates"]["start"]
-        == sample["variantSet"]["variant"][0]["chromosomeCoordinates"]["stop"]
-    ):
+    variant = sample["variantSet"]["variant"][0]
+    coordinates = variant["chromosomeCoordinates"]
+    ref_allele = coordinates["referenceAllele"]
+    alt_allele = coordinates["alternateAllele"]
+    if coordinates["start"] == coordinates["stop"]:
         if ref_allele == "-":
-            sample["variantSet"]["variant"][0]["variantType"] = "Insertion"
-            sample["variantSet"]["variant"][0]["chromosomeCoordinates"]["stop"] += 1
+            variant["variantType"] = "Insertion"
+            coordinates["stop"] += 1
     else:
         if alt_allele == "-":
-            sample["variantSet"]["variant"][0]["variantType"] = "Deletion"
-            sample["variantSet"]["variant"][0]["chromosomeCoordinates"]["start"] += 1
+            variant["variantType"] = "Deletion"
+            coordinates["start"] += 1
         else:
             if len(ref_allele) == len(alt_allele) == 1:
-                sample["variantSet"]["variant"][0]["chromosomeCoordinates"][
-                    "start"
-                ] += 1
+                coordinates["start"] += 1
     return sample
 
 
@@ -74,15 +125,14 @@ def coordinates_check(variants_list):
         Modified variants list."""
     final_list = []
     for sample in variants_list:
-        if "chromosomeCoordinates" in sample["variantSet"]["variant"][0].keys():
+        if "chromosomeCoordinates" in sample["variantSet"]["variant"][0]:
             final_list.append(fix_coordinates(sample))
         else:
-            final_list.append(
-                sample
-            )
+            final_list.append(sample)
     return final_list
 
 
+@lru_cache(maxsize=None)
 def fix_hgvs(hgvs, alt):
     """Function to modify the HGVS syntax when uncertain.
 
@@ -99,12 +149,12 @@ def fix_hgvs(hgvs, alt):
     if "(" in hgvs:
         values = hgvs.split(",")
         if len(values) == 2:
-            value1 = sub("[\(].*?[\)]", get_reverse_strand(alt), values[0])
+            value1 = PARENTHESIS_PATTERN.sub(get_reverse_strand(alt), values[0])
             modified_hgvs.append(value1)
-            value2 = sub("[\(].*?[\)]", alt, values[1])
+            value2 = PARENTHESIS_PATTERN.sub(alt, values[1])
             modified_hgvs.append(value2)
         else:
-            modified_hgvs.append(sub("[\(].*?[\)]", get_reverse_strand(alt), values[0]))
+            modified_hgvs.append(PARENTHESIS_PATTERN.sub(get_reverse_strand(alt), values[0]))
         #print(f'Old hgvs c.: {hgvs} \n New hgvs c.: {",".join(modified_hgvs)}')
     return ",".join(modified_hgvs)
 
@@ -118,13 +168,42 @@ def check_hgvs(sample):
     Return:
         Boolean value: "True" if hgvs is present, "False" if not."""
 
-    if sample["hgvs c."]:
-        if "(" in sample["hgvs c."]:
-            sample["hgvs c."] = fix_hgvs(
-                sample["hgvs c."], sample["Ref/Alt"].split("/")[1]
-            )
-        return True
-    return False
+    hgvs = sample["hgvs c."]
+    if not hgvs:
+        return False
+    if "(" in hgvs:
+        sample["hgvs c."] = fix_hgvs(hgvs, sample["Ref/Alt"].split("/")[1])
+    return True
+
+
+def build_single_variant(variant, hgvs, gene):
+    """Function to create a copy of the variant with a single HGVS and its associated gene.
+    Only the branch holding hgvs and gene symbol is rebuilt, the rest is shared with the inputted variant.
+
+    Parameters:
+        variant: variant of interest.
+        hgvs: HGVS to be kept in the new variant.
+        gene: gene associated to the HGVS.
+
+    Return:
+        New single variant."""
+
+    variant_set = variant["variantSet"]
+    first_variant = variant_set["variant"][0]
+    return {
+        **variant,
+        "variantSet": {
+            **variant_set,
+            "variant": [
+                {
+                    **first_variant,
+                    "hgvs": hgvs,
+                    "gene": [{**first_variant["gene"][0], "symbol": gene}, *first_variant["gene"][1:]],
+                },
+                *variant_set["variant"][1:],
+            ],
+        },
+    }
 
 
 def extract_variants(hgvs_list, variant):
@@ -140,19 +219,17 @@ def extract_variants(hgvs_list, variant):
     Return:
         List of single extracted variants from the inputted one."""
 
-    variants_list = []
     genes_list = variant["variantSet"]["variant"][0]["gene"][0]["symbol"].split(",")
-    for i in range(len(hgvs_list)):
-        if not hgvs_list[i].startswith("NM"):
-            continue
-        else:
-            single_variant = copy.deepcopy(variant)
-            single_variant["variantSet"]["variant"][0]["hgvs"] = hgvs_list[i]
-            single_variant["variantSet"]["variant"][0]["gene"][0][
-                "symbol"
-            ] = genes_list[i]
-            variants_list.append(single_variant)
-    return variants_list
+    missing_genes = [hgvs for hgvs in hgvs_list[len(genes_list):] if hgvs.startswith("NM")]
+    if missing_genes: #NM transcripts without gene would otherwise be dropped silently
+        raise ValueError(
+            f"No gene associated to {','.join(missing_genes)} (genes: {','.join(genes_list)})"
+        )
+    return [
+        build_single_variant(variant, hgvs, gene)
+        for hgvs, gene in zip(hgvs_list, genes_list)
+        if hgvs.startswith("NM")
+    ]
 
 
 def multiple_hgvs(sample):
@@ -168,11 +245,11 @@ def multiple_hgvs(sample):
     Return:
         The separated variants if multiple HGVS present or "None" otherwise."""
 
-    hgvs_list = sample["variantSet"]["variant"][0]["hgvs"].split(",")
-    if len(hgvs_list) == 1:
+    hgvs = sample["variantSet"]["variant"][0]["hgvs"]
+    if "," not in hgvs:  # single HGVS, no need to split
         return None
     else:
-        single_variants = extract_variants(hgvs_list, sample)
+        single_variants = extract_variants(hgvs.split(","), sample)
         return single_variants
 
 
@@ -189,30 +266,49 @@ def convert_variant(variants_entries, date_of_upload, somatic_flag, to_update=Fa
     Returns:
         variants_list: list of variants correctly formatted."""
 
+    # values only depending on the type of submission
+    classification_key, description_key = (
+        ("oncogenicityClassification", "oncogenicityClassificationDescription") if somatic_flag
+        else ("germlineClassification", "germlineClassificationDescription")
+    )
+    affected_status = "yes" if somatic_flag else "unknown"  # we choose 'unknown' as default for germline
+    allele_origin = "somatic" if somatic_flag else "germline"
+    record_status = "update" if to_update else "novel"
+
+    get_fields = itemgetter("Classification", "Gene Names")
+    get_coordinates = itemgetter("#Chromosome", "Start", "Stop", "Ref/Alt")
+
     variants_list = []
     for variant in variants_entries:
-        variant["Classification"] = variant["Classification"].capitalize()
-        if variant["Classification"] == "Unknown significance":
-            variant["Classification"] = "Uncertain significance"  # ClinVar requirement
-        if somatic_flag:
-            variant["Classification"] = SOMATIC_CLASSIFICATION_MAPPING[variant["Classification"]]
-        
+        classification, gene_names = get_fields(variant)
+        classification = normalize_classification(classification, somatic_flag)
+        variant["Classification"] = classification
+
         condition_second_field = (
             {"id": "C0027651"} if somatic_flag else
-            {"name": (
-                "not specified"
-                if variant["Classification"] in ["Benign", "Likely benign", "Uncertain significance"]
-                else "not provided"
-            )}
+            {"name": "not specified" if classification in NOT_SPECIFIED_CLASSIFICATIONS else "not provided"}
         )
-        
+
+        location = {"gene": [{"symbol": gene_names}]}
+        if check_hgvs(variant):  # may fix the hgvs c., hence read afterwards
+            location["hgvs"] = variant["hgvs c."]
+        else:
+            chromosome, start, stop, ref_alt = get_coordinates(variant)
+            start, stop = int(start), int(stop)
+            coordinates = {
+                "assembly": "hg38",
+                "chromosome": chromosome,
+                "start": start,
+                "stop": stop,
+            }
+            # reference and alternate alleles are only to be provided if variant is smaller than 50nt
+            if stop - start <= 50:
+                coordinates["referenceAllele"], coordinates["alternateAllele"] = ref_alt.split("/")[:2]
+            location["chromosomeCoordinates"] = coordinates
+
         sample_variant = {
-            ("germlineClassification" 
-             if not somatic_flag
-             else "oncogenicityClassification"): {
-                ("germlineClassificationDescription"
-                 if not somatic_flag
-                 else "oncogenicityClassificationDescription"): variant["Classification"],
+            classification_key: {
+                description_key: classification,
                 "dateLastEvaluated": date_of_upload,
             },
             "conditionSet": {
@@ -225,53 +321,16 @@ def convert_variant(variants_entries, date_of_upload, somatic_flag, to_update=Fa
             },
             "observedIn": [
                 {
-                    "affectedStatus": (
-                        "unknown" if not somatic_flag # we choose 'unknown' as default
-                        else "yes" 
-                    ),
-                    "alleleOrigin": (
-                        "germline" if not somatic_flag
-                        else "somatic"
-                    ),
+                    "affectedStatus": affected_status,
+                    "alleleOrigin": allele_origin,
                     "collectionMethod": "clinical testing",  # we choose 'clinical testing' as default
                 }
             ],
-            "recordStatus": "novel" if not to_update else "update",
-            "variantSet": {
-                "variant": [
-                    {
-                        "gene": [{"symbol": variant["Gene Names"]}],
-                        (
-                            "hgvs"
-                            if check_hgvs(variant)
-                            else "chromosomeCoordinates"
-                        ): (
-                            variant["hgvs c."]
-                            if variant["hgvs c."]
-                            else {
-                                "assembly": "hg38",
-                                "chromosome": variant["#Chromosome"],
-                                "start": int(variant["Start"]),
-                                "stop": int(variant["Stop"]),
-                            }
-                        ),
-                    }
-                ]
-            },
+            "recordStatus": record_status,
+            "variantSet": {"variant": [location]},
         }
         if to_update:  # if variants to be updated then SCV field required
             sample_variant["clinvarAccession"] = variant["SCV"]
-        # reference and alternate alleles are only to be provided if variant is smaller than 50nt
-        if (
-            "chromosomeCoordinates" in sample_variant["variantSet"]["variant"][0].keys()
-            and int(variant["Stop"]) - int(variant["Start"]) <= 50
-        ):
-            sample_variant["variantSet"]["variant"][0]["chromosomeCoordinates"][
-                "referenceAllele"
-            ] = variant["Ref/Alt"].split("/")[0]
-            sample_variant["variantSet"]["variant"][0]["chromosomeCoordinates"][
-                "alternateAllele"
-            ] = variant["Ref/Alt"].split("/")[1]
         variants_list.append(sample_variant)
     return variants_list
 
@@ -287,11 +346,7 @@ def format_haplo_variants(variants_list):
         output_variants: formatted list of variants for haplotype submission.
     """
 
-    output_variants = []
-    for hgvsc in variants_list.split(", "):
-        formatted_variant = {}
-        formatted_variant["hgvs"] = hgvsc
-        output_variants.append(formatted_variant)
+    output_variants = [{"hgvs": hgvsc} for hgvsc in variants_list.split(", ")]
     return output_variants
 
 
@@ -307,35 +362,30 @@ def convert_haplotype(haplo_entries, date_of_upload, somatic_flag, to_update):
     Returns:
         haplotypes_list: list of haplotypes correctly formatted for submission."""
 
+    # values only depending on the type of submission
+    classification_key, description_key = (
+        ("oncogenicityClassification", "oncogenicityClassificationDescription") if somatic_flag
+        else ("germlineClassification", "germlineClassificationDescription")
+    )
+    affected_status = "yes" if somatic_flag else "unknown"
+    allele_origin = "somatic" if somatic_flag else "germline"
+    record_status = "update" if to_update else "novel"
+
     haplotypes_list = []
 
-    for haplo in haplo_entries:
-        if to_update:
-            associated_variants, haplo_hgvsc, haplo_hgvsp, haplo_classification, upload_type, last_edited_date, haplo_SCV = haplo_entries[haplo].strip(" ").split("; ")
-        else:
-            associated_variants, haplo_hgvsc, haplo_hgvsp, haplo_classification, upload_type, last_edited_date = haplo_entries[haplo].strip(" ").split("; ")
-        haplo_classification = haplo_classification.capitalize()
-        if haplo_classification == "Unknown significance":
-            haplo_classification = "Uncertain significance"
-        if somatic_flag:
-            haplo_classification = SOMATIC_CLASSIFICATION_MAPPING[haplo_classification]
+    for haplo_fields in haplo_entries.values():
+        # first six fields from check_input.clean_data, SCV appended by check_for_updates when to be updated
+        associated_variants, haplo_hgvsc, haplo_hgvsp, haplo_classification, upload_type, last_edited_date = haplo_fields[:6]
+        haplo_classification = normalize_classification(haplo_classification, somatic_flag)
         
         condition_second_field = (
             {"id": "C0027651"} if somatic_flag else
-            {"name": (
-                "not specified"
-                if haplo_classification in ["Benign", "Likely benign", "Uncertain significance"]
-                else "not provided"
-            )}
+            {"name": "not specified" if haplo_classification in NOT_SPECIFIED_CLASSIFICATIONS else "not provided"}
         )
 
         sample_variant = {
-            ("germlineClassification" 
-             if not somatic_flag
-             else "oncogenicityClassification"): {
-                ("germlineClassificationDescription"
-                 if not somatic_flag
-                 else "oncogenicityClassificationDescription"): haplo_classification,
+            classification_key: {
+                description_key: haplo_classification,
                 "dateLastEvaluated": date_of_upload,
             },
             "conditionSet": {
@@ -348,25 +398,19 @@ def convert_haplotype(haplo_entries, date_of_upload, somatic_flag, to_update):
             },
             "observedIn": [
                 {
-                    "affectedStatus": (
-                        "unknown" if not somatic_flag
-                        else "yes" 
-                    ),
-                    "alleleOrigin": (
-                        "germline" if not somatic_flag
-                        else "somatic"
-                    ),
+                    "affectedStatus": affected_status,
+                    "alleleOrigin": allele_origin,
                     "collectionMethod": "clinical testing",
                 }
             ],
-            "recordStatus":"novel" if not to_update else "update",
+            "recordStatus": record_status,
             "haplotypeSet": {
                 "hgvs": haplo_hgvsc,
                 "variants": format_haplo_variants(associated_variants)
             },
         }
         if to_update:  # if variants to be updated then SCV field required
-            sample_variant["clinvarAccession"] = haplo_SCV
+            sample_variant["clinvarAccession"] = haplo_fields[6]
         haplotypes_list.append(sample_variant)
     return haplotypes_list
 
@@ -379,21 +423,18 @@ def write_haplotypes_file(haplotypes_dict, file_path, date_of_upload):
         file_path: output's filepath.
         date_of_upload: date of upload needed for annotation.
     """
-    lines = []
-    for haplotype in haplotypes_dict:
-        associated_variants, haplo_hgvsc, haplo_hgvsp, haplo_classification, upload_type, last_edited = haplotypes_dict[haplotype].strip(" ").split("; ")[:6] #if to be updated skip SCV and add later again with annotation
-        lines.append([haplo_hgvsc, haplo_classification, associated_variants, haplo_hgvsp, date_of_upload])
-    if os.path.exists(file_path):
-        with open(file_path, 'a', newline='', encoding='utf-8') as tsvfile:
-            writer = csv.writer(tsvfile, delimiter='\t')
-            writer.writerows(lines)
-    else:
-        with open(file_path, 'w', newline='', encoding='utf-8') as tsvfile:
-            writer = csv.writer(tsvfile, delimiter='\t')
+    # rows generated while writing, to avoid holding a second copy of the haplotypes
+    lines = (
+        [haplo_hgvsc, haplo_classification, associated_variants, haplo_hgvsp, date_of_upload]
+        for associated_variants, haplo_hgvsc, haplo_hgvsp, haplo_classification, *_ in haplotypes_dict.values() #if to be updated skip SCV and add later again with annotation
+    )
+    with open(file_path, 'a', buffering=BUFFER_SIZE, newline='', encoding='utf-8') as tsvfile:
+        writer = csv.writer(tsvfile, delimiter='\t')
+        if tsvfile.tell() == 0:  # file just created (or empty), header needed
             print("File created")
             header = ["hgvs c.", "Classification", "Variants", "hgvs p.", "Last Edited"]
             writer.writerow(header)
-            writer.writerows(lines)
+        writer.writerows(lines)
     return
 
 def format_deletion(scv_entries):
@@ -1,13 +1,31 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
-import json
+import gzip
+from itertools import islice
 import os
 import sys
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 import helper_functions, check_input, check_for_updates
 from datetime import datetime
 
+STATUS_CHOICES = ("novel", "update", "delete")
+MAX_WORKERS = 8  # batches posted at the same time
+RETRY = Retry(  # only retried when the server did not process the request (rate limit, unavailable), as POST creates a new submission
+    total=5,
+    read=0,  # response lost after the request was sent, not posted again
+    backoff_factor=0.5,
+    status_forcelist=[429, 503],
+    allowed_methods=["POST"],  # requires urllib3>=1.26
+    respect_retry_after_header=True,
+    raise_on_status=False  # last response returned, and written to the errors file
+)
+REQUEST_TIMEOUT = (10, 300)  # seconds to connect and to wait for the response of a batch
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Provide data to be uploaded and reference file.")
@@ -38,7 +56,7 @@ def parse_arguments():
         "-s",
         "--status",
         help='Set to "update" if the submitted variants are already present on ClinVar and need to be updated (default = "update")',
-        choices=["novel", "update", "delete"],
+        choices=STATUS_CHOICES,
         default="update"
     )
     parser.add_argument(
@@ -56,6 +74,17 @@ def parse_arguments():
         type=int,
         default=500
     )
+    parser.add_argument(
+        "--gzip",
+        help="To send the submissions gzip-compressed (check first with a dry run that the API accepts them)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="To print the full responses (headers or text) of the API",
+        action="store_true"
+    )
     parser.add_argument(
         "--date_of_extraction",
         help="Date of extraction of variants from VarSeq (API upload date does not reflect this as always done with some delay)",
@@ -64,15 +93,17 @@ def parse_arguments():
     return parser
 
 
-def submit_request(list_of_variants, submission_url, headers, variant_type, deletion = False):
+def submit_request(session, list_of_variants, submission_url, headers, variant_type, deletion = False, gzip_enabled = None):
     """Function to post the request for submission of each batch of variants.
     If the deletion argument is set to True, the function posts the request for the deletion of the submitted variants.
 
     Parameters:
+        session: requests.Session reused for all the batches, so that the connection to the API is kept open.
         list_of_variants (list): list of the batch of variants to be submitted.
         submission_url: submission url for dry or live run (based on -n argument).
         headers: headers with extra info needed for the submission.
         deletion: Boolean value for submission of deletion of variants.
+        gzip_enabled: threading.Event set while bodies are to be compressed (based on --gzip argument), cleared if the API rejects them.
 
     Return:
         Response object (dict) from the attempted submission."""
@@ -103,89 +134,119 @@ def submit_request(list_of_variants, submission_url, headers, variant_type, dele
             {"type": "AddData", "targetDb": "clinvar", "data": {"content": content}}
         ]
     }
-    response = requests.post(url=submission_url, headers=headers, data=json.dumps(data))
+    body = helper_functions.dump_json(data, indent=False)
+    if gzip_enabled is not None and gzip_enabled.is_set() and len(body) > 1024: #small requests (e.g. deletions) not worth compressing
+        response = session.post(url=submission_url, headers={**headers, "Content-Encoding": "gzip"}, data=gzip.compress(body, compresslevel=6), timeout=REQUEST_TIMEOUT)
+        if response.status_code != 415: #415 Unsupported Media Type: compression not accepted, batch sent again as it is
+            return response
+        gzip_enabled.clear() #not compressed for the rest of the run
+    response = session.post(url=submission_url, headers=headers, data=body, timeout=REQUEST_TIMEOUT)
     return response
 
 
 
-def submit_variants(variants_list, variant_type, variant_status, haplo = False):
+def get_submission_id(response):
+    """Function to retrieve the submission id from the response of the API.
+
+    Parameters:
+        response: response object from the attempted submission.
+
+    Return:
+        Submission id, or "None" if the response does not contain one (e.g. failed submission)."""
+
+    try:
+        return response.json().get("id")
+    except ValueError: #body not in json format
+        return None
+
+
+def submit_variants(session, variants_list, variant_type, variant_status, submission_url, headers, batch_size = 500, verbose = False, haplo = False, gzip_enabled = None):
     """Wrapper function responible for uploading the novel or updated variants.
 
     Parameters:
+        session: requests.Session shared by all the submissions of the run.
         varinats_list: list of variants to be uploaded.
         variant_status: string indicating whether the variants are novel or to be updated.
-        haplo: Boolean value to define whether variants or haplotypes are to be uploaded."""
+        submission_url: submission url for dry or live run (based on -n argument).
+        headers: headers with the API key needed for the submission.
+        batch_size: maximum number of variants per submission (based on -b argument).
+        verbose: Boolean value to print the full responses of the API (based on -v argument).
+        haplo: Boolean value to define whether variants or haplotypes are to be uploaded.
+        gzip_enabled: threading.Event set while bodies are to be compressed, shared by all the submissions of the run."""
 
-    status_choices = ["novel", "update", "delete"]
-    if variant_status not in status_choices:
-        raise ValueError("Invalid sim type. Expected one of: %s" % status_choices)
-    if args.dryrun:
-        submission_url = helper_functions.TEST_URL
-    else:
-        submission_url = helper_functions.SUB_URL
-    
-    api_key = args.key.read_text()
-    headers = {"Content-Type": "application/json", "SP-API-KEY": api_key}
+    if variant_status not in STATUS_CHOICES:
+        raise ValueError("Invalid sim type. Expected one of: %s" % list(STATUS_CHOICES))
 
     if variant_status == "delete":
-        response = submit_request(variants_list, submission_url, headers, variant_type, deletion = True)
+        response = submit_request(session, variants_list, submission_url, headers, variant_type, deletion = True)
         print(f"Response ({variant_status}): {response.status_code}")
-        sub_id = response.text.strip("{}").split(":")[1].strip('"')
+        sub_id = get_submission_id(response)
         print(f"Submission id: {sub_id}")
-        print(response.headers)
+        if verbose:
+            print(response.headers)
         return
     
     print(f"[INFO]: Submitting variants for upload ({variant_status})...")
-    responses = []
     variants_number = len(variants_list)
-    variants_batches = [
-        variants_list[i : i + args.batch_size]
-        for i in range(0, len(variants_list), args.batch_size)
-    ]
-    for batch in variants_batches:
-        responses.append(submit_request(batch, submission_url, headers, variant_type))
+    variants_iterator = iter(variants_list)
+    variants_batches = list(iter(lambda: list(islice(variants_iterator, batch_size)), []))
     
     # -------on-screen message
-    print(f'{"Live run" if args.dryrun == False else "Dry run"} at: {submission_url}')
+    print(f'{"Dry run" if submission_url == helper_functions.TEST_URL else "Live run"} at: {submission_url}')
     print(f"Number variants submitted: {variants_number}")
-    summaries_list = []
+    kind = "haplotypes" if haplo else "variants"
+    artifact_suffix = f"-{variant_type}_{kind}_{variant_status}.json" #appended to the submission id
+    file_path = os.path.join("temp", f"{variant_type}_summaries_list_{variant_status}.txt")
+    with open(file_path, mode = 'a') as summaries_file, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        #batches posted concurrently, each response recorded as soon as it arrives so that a failing batch does not lose the others
+        futures = {
+            executor.submit(submit_request, session, batch, submission_url, headers, variant_type, gzip_enabled = gzip_enabled): (count, batch)
+            for count, batch in enumerate(variants_batches, 1)
+        }
+        for future in as_completed(futures):
+            count, batch = futures[future]
+            try:
+                response = future.result()
+            except requests.RequestException as error: #e.g. timeout or connection lost, the batch may or may not have been received
+                print(f"Response ({variant_status}): {type(error).__name__} for batch {count}")
+                with open(
+                    f"Submission_errors_{variant_status}_{count}.txt", mode="w"
+                ) as output_file:
+                    output_file.write(repr(error))
+                continue
+            print(f"Response ({variant_status}): {response.status_code}")
+            sub_id = get_submission_id(response)
+            print(f"Submission id: {sub_id}")
+            if verbose:
+                print(response.text)
 
-    for count, response in enumerate(responses, 1):
-        print(f"Response ({variant_status}): {response.status_code}")
-        sub_id = response.text.strip("{}").split(":")[1].strip('"')
-        print(f"Submission id: {sub_id}")
-        print(response.text)
-
-        if response.status_code > 201:
-            with open(
-                f"Submission_errors_{variant_status}_{count}.txt", mode="w"
-            ) as output_file:
-                output_file.write(str(response.headers))
-                output_file.write("\n")
-                output_file.write(response.text)
-        else:
-            data = json.dumps(variants_batches, indent=2)
-            with open(f'temp\\{sub_id}-{variant_type}_{"variants" if not haplo else "haplotypes"}_{variant_status}.json', mode="w") as output_file:
-                header = dict(response.headers)
-                header["Total number of variants submitted"] = variants_number
-                output_file.write(json.dumps(header, indent=2))
-                output_file.write(data)
-            report_json = f'temp\\{sub_id}-summary-report.json {"variants" if not haplo else "haplotypes"}'
-            summaries_list.append(report_json)
-        # if haplo and variant_status=="novel":
-        #     helper_functions.write_haplotypes_file(variants_list, f"temp\{variant_type}_haplotypes_uploaded.txt", date_of_extraction)
-        file_path = f'temp\{variant_type}_summaries_list_{variant_status}.txt'
-        with open(file_path, mode = 'a' if os.path.exists(file_path) else 'w') as summaries_file:
-            #writes file with summary jsons path to be used for annotation
-            for json_file in summaries_list:
-                summaries_file.write(json_file)
+            if response.status_code > 201:
+                with open(
+                    f"Submission_errors_{variant_status}_{count}.txt", mode="w"
+                ) as output_file:
+                    output_file.write(str(response.headers))
+                    output_file.write("\n")
+                    output_file.write(response.text)
+            else:
+                with open(os.path.join("temp", f"{sub_id}{artifact_suffix}"), mode="wb") as output_file:
+                    header = dict(response.headers)
+                    header["Total number of variants submitted"] = variants_number
+                    output_file.write(helper_functions.dump_json(header))
+                    output_file.write(helper_functions.dump_json(batch)) #variants of this submission only
+                report_json = f'{os.path.join("temp", f"{sub_id}-summary-report.json")} {kind}'
+                summaries_file.write(report_json)
                 summaries_file.write("\n")
-        print("[INFO]: Variant submission to ClinVar API completed!")
-        print("------IMPORTANT! Remember to annotate the data after successful upload------ \n \n")
+                summaries_file.flush() #recorded straight away for annotation, even if the run stops later
+            # if haplo and variant_status=="novel":
+            #     helper_functions.write_haplotypes_file(variants_list, f"temp\{variant_type}_haplotypes_uploaded.txt", date_of_extraction)
+    print("[INFO]: Variant submission to ClinVar API completed!")
+    print("------IMPORTANT! Remember to annotate the data after successful upload------ \n \n")
 
 
 # ----------main execution-------------------
-if __name__ == "__main__":
+def main():
+    """Function running the cleaning, comparison and submission of the variants and haplotypes from the command line arguments."""
+
     parser = parse_arguments()
     args = parser.parse_args()
 
@@ -203,6 +264,11 @@ if __name__ == "__main__":
         input_catalogue = args.file_somatic
     else:
         parser.error("NO input file provided")
+    somatic_flag = variant_type == "somatic"
+
+    #read once for all the submissions
+    submission_url = helper_functions.TEST_URL if args.dryrun else helper_functions.SUB_URL
+    headers = {"Content-Type": "application/json", "SP-API-KEY": args.key.read_text().strip()}
 
     if len(args.date_of_extraction) == 10:
         try:
@@ -215,8 +281,13 @@ if __name__ == "__main__":
         print("Error: Date of extraction must be in format %YYYY-%mm-%dd")
         sys.exit(1)
     
-    if not os.path.exists(".\\temp\\"):
-        os.makedirs(".\\temp\\")
+    os.makedirs("temp", exist_ok=True)
+
+    gzip_enabled = threading.Event() #compression only if requested, turned off for the run if rejected by the API
+    if args.gzip:
+        gzip_enabled.set()
+    session = requests.Session() #connections kept open for all the batches and phases of the run
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=RETRY))
 
     if args.status == "delete":
         print("[INFO]: Submitting variants to be deleted...")
@@ -224,7 +295,7 @@ if __name__ == "__main__":
             csv_reader = csv.DictReader(input_tsv, delimiter="\t")
             scv_list = [variant["SCV"] for variant in csv_reader]
         variants_list = helper_functions.format_deletion(scv_list)
-        submit_variants(variants_list, variant_type, variant_status = "delete")
+        submit_variants(session, variants_list, variant_type, variant_status = "delete", submission_url = submission_url, headers = headers, batch_size = args.batch_size, verbose = args.verbose, gzip_enabled = gzip_enabled)
     else: #in case of upload/update
         print(f"[INFO]: Cleaning data from {input_catalogue}...")
         input_file, haplotypes_dict = check_input.clean_data(input_catalogue)
@@ -238,9 +309,9 @@ if __name__ == "__main__":
                 print(len(variants_novel))
                 # print(variants_novel)
                 variants_novel_formatted = helper_functions.convert_variant(variants_novel, date_of_extraction, 
-                                                                            somatic_flag = (True if variant_type == "somatic" else False))
+                                                                            somatic_flag = somatic_flag)
                 variants_novel_formatted = helper_functions.coordinates_check(variants_novel_formatted)
-                submit_variants(variants_novel_formatted, variant_type, variant_status="novel")
+                submit_variants(session, variants_novel_formatted, variant_type, variant_status="novel", submission_url = submission_url, headers = headers, batch_size = args.batch_size, verbose = args.verbose, gzip_enabled = gzip_enabled)
             else:
                 print("[INFO]: No novel variants to be uploaded.")
             
@@ -249,9 +320,9 @@ if __name__ == "__main__":
                 print(len(variants_update))
                 # print(variants_update)
                 variants_update_formatted = helper_functions.convert_variant(variants_update, date_of_extraction, to_update=True,
-                                                                             somatic_flag = (True if variant_type == "somatic" else False))
+                                                                             somatic_flag = somatic_flag)
                 variants_update_formatted = helper_functions.coordinates_check(variants_update_formatted)
-                submit_variants(variants_update_formatted, variant_type, variant_status="update")
+                submit_variants(session, variants_update_formatted, variant_type, variant_status="update", submission_url = submission_url, headers = headers, batch_size = args.batch_size, verbose = args.verbose, gzip_enabled = gzip_enabled)
             else:
                 print("[INFO]: No variants to be updated.")
             
@@ -260,34 +331,36 @@ if __name__ == "__main__":
                 haplos_novel, haplos_update = check_for_updates.compare_haplotypes(haplotypes_dict, args.reference_haplotypes)
                 if len(haplos_novel) != 0:
                     haplotypes_upload_formatted = helper_functions.convert_haplotype(haplos_novel, date_of_extraction, to_update= False,
-                                                                                     somatic_flag = (True if variant_type == "somatic" else False))
-                    submit_variants(haplotypes_upload_formatted, variant_type, variant_status="novel", haplo = True)
-                    helper_functions.write_haplotypes_file(haplos_novel, f"temp\{variant_type}_haplotypes_uploaded.txt", date_of_extraction)
+                                                                                     somatic_flag = somatic_flag)
+                    submit_variants(session, haplotypes_upload_formatted, variant_type, variant_status="novel", submission_url = submission_url, headers = headers, batch_size = args.batch_size, verbose = args.verbose, gzip_enabled = gzip_enabled, haplo = True)
+                    helper_functions.write_haplotypes_file(haplos_novel, os.path.join("temp", f"{variant_type}_haplotypes_uploaded.txt"), date_of_extraction)
                 else:
                     print("[INFO]: No novel haplotypes to be uploaded")
                 if len(haplos_update) != 0:
                     haplotypes_update_formatted = helper_functions.convert_haplotype(haplos_update, date_of_extraction, to_update= True,
-                                                                                     somatic_flag = (True if variant_type == "somatic" else False))
-                    submit_variants(haplotypes_update_formatted, variant_type, variant_status="update", haplo = True)
-                    helper_functions.write_haplotypes_file(haplos_update, f"temp\{variant_type}_haplotypes_uploaded.txt", date_of_extraction)
+                                                                                     somatic_flag = somatic_flag)
+                    submit_variants(session, haplotypes_update_formatted, variant_type, variant_status="update", submission_url = submission_url, headers = headers, batch_size = args.batch_size, verbose = args.verbose, gzip_enabled = gzip_enabled, haplo = True)
+                    helper_functions.write_haplotypes_file(haplos_update, os.path.join("temp", f"{variant_type}_haplotypes_uploaded.txt"), date_of_extraction)
                 else:
                     print("[INFO]: No haplotypes to be updated.")
         else:
             print(f"[INFO]: Parsing through the novel variants...")
             with open(input_file, encoding="utf-8", mode="r") as tsv:
                 csv_reader = csv.DictReader(tsv, delimiter="\t")
-                input_entries = []
-                for variant in csv_reader:
-                    input_entries.append(variant)
-            variants_list = helper_functions.convert_variant(input_entries, date_of_extraction, 
-                                                             somatic_flag = (True if variant_type == "somatic" else False))
-            submit_variants(variants_list, variant_type, variant_status="novel")
+                #rows converted while being read, without keeping the raw entries in memory
+                variants_list = helper_functions.convert_variant(csv_reader, date_of_extraction, 
+                                                                 somatic_flag = somatic_flag)
+            submit_variants(session, variants_list, variant_type, variant_status="novel", submission_url = submission_url, headers = headers, batch_size = args.batch_size, verbose = args.verbose, gzip_enabled = gzip_enabled)
             print(f"[INFO]: Looking at haplotypes...")
             if haplotypes_dict:
                 haplotypes_upload_formatted = helper_functions.convert_haplotype(haplotypes_dict, date_of_extraction, to_update= False,
-                                                                                 somatic_flag = (True if variant_type == "somatic" else False))
-                submit_variants(haplotypes_upload_formatted, variant_type, variant_status="novel", haplo = True)
-                helper_functions.write_haplotypes_file(haplotypes_dict, f"temp\{variant_type}_haplotypes_uploaded.txt", date_of_extraction)
+                                                                                 somatic_flag = somatic_flag)
+                submit_variants(session, haplotypes_upload_formatted, variant_type, variant_status="novel", submission_url = submission_url, headers = headers, batch_size = args.batch_size, verbose = args.verbose, gzip_enabled = gzip_enabled, haplo = True)
+                helper_functions.write_haplotypes_file(haplotypes_dict, os.path.join("temp", f"{variant_type}_haplotypes_uploaded.txt"), date_of_extraction)
             else:
                 print("[INFO]: No haplotypes to be uploaded.")
+    session.close()
+
 
+if __name__ == "__main__":
+    main()